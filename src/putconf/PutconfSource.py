@@ -1,12 +1,26 @@
+import collections
+import concurrent.futures
 from enum import Enum
 import itertools
-import re
 import shutil
+import stat
 import subprocess
+import sys
 import tempfile
 import typing
+import weakref
 import os
 
+try: import pygit2
+except ImportError: pygit2 = None
+
+if sys.platform.startswith("linux"):
+    import fcntl
+    _FICLONE = 0x40049409
+    """ioctl request to reflink one file to another."""
+else:
+    _FICLONE = None
+
 class OverwriteMode(Enum):
     PROMPT = 1
     ALL = 2
@@ -15,28 +29,311 @@ class OverwriteMode(Enum):
 def _prepend_dot(path):
     return "." + str(path)
 
+_git_jobs = str(os.cpu_count() or 4)
+"""Number of parallel jobs git may use when fetching submodules."""
+
+def _have_git(git_exe):
+    """Whether git operations can be performed, either in-process through pygit2
+    or by running git_exe."""
+    return pygit2 is not None or git_exe is not None
+
+def _pygit2_callbacks():
+    class Callbacks(pygit2.RemoteCallbacks):
+        def credentials(self, url, username_from_url, allowed_types):
+            if not allowed_types & pygit2.enums.CredentialType.SSH_KEY:
+                # let libgit2 fall back to its defaults
+                raise pygit2.Passthrough
+            # use ssh-agent, like the git command would
+            return pygit2.KeypairFromAgent(username_from_url or "git")
+    return Callbacks()
+
+def _pygit2_pull(repo_dir):
+    """Fetch and fast-forward the current branch of repo_dir in-process. Returns
+    False if the pull requires a merge, which is left to the git executable."""
+    try:
+        repo = pygit2.Repository(repo_dir)
+        if repo.head_is_detached:
+            return False
+        branch = repo.branches.local[repo.head.shorthand]
+        upstream = branch.upstream
+        if upstream is None:
+            return False
+        repo.remotes[upstream.remote_name].fetch(callbacks=_pygit2_callbacks())
+        target = repo.branches.remote[upstream.branch_name].target
+        analysis, _ = repo.merge_analysis(target)
+        if analysis & pygit2.GIT_MERGE_ANALYSIS_UP_TO_DATE:
+            print("Already up to date.")
+        elif analysis & pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD:
+            repo.checkout_tree(repo.get(target))
+            branch.set_target(target)
+        else:
+            return False
+        return True
+    except (pygit2.GitError, KeyError, ValueError) as e:
+        raise RuntimeError("Git pull failed: %s" % e)
+
 def _git_pull(git_exe, repo_dir):
-    pull_proc = subprocess.run([git_exe, "-C", repo_dir, "pull"])
+    if pygit2 is not None:
+        try:
+            if _pygit2_pull(repo_dir):
+                return
+        except RuntimeError:
+            # the git executable handles setups libgit2 doesn't (e.g. ssh
+            # config), so give it a try before failing
+            if git_exe is None:
+                raise
+    if git_exe is None:
+        raise RuntimeError("Git not found.")
+    pull_proc = subprocess.run([git_exe, "-C", repo_dir, "pull", "--jobs", _git_jobs])
     if pull_proc.returncode != 0:
-        raise RuntimeError("Git pull failed with code %i.", pull_proc.returncode)
-
-def _do_mkdir(path, verbose=False, dry_run=False):
-    if os.path.exists(path):
-        if verbose:
-            print("Directory already exists: %s" % path)
+        raise RuntimeError("Git pull failed with code %i." % pull_proc.returncode)
+
+def _looks_like_commit(gitref):
+    """Check whether gitref could be an abbreviated or full commit hash."""
+    return len(gitref) >= 4 and all(c in "0123456789abcdefABCDEF" for c in gitref)
+
+def _pygit2_clone(url, dest, is_remote, gitref=None):
+    try:
+        repo = None
+        if gitref and not _looks_like_commit(gitref):
+            # like clone --branch in _git_clone, check out a branch while
+            # cloning, and for remotes only fetch its tip. (The local transport
+            # doesn't support shallow fetches.)
+            try:
+                repo = pygit2.clone_repository(url, dest, checkout_branch=gitref,
+                                               depth=1 if is_remote else 0,
+                                               callbacks=_pygit2_callbacks())
+            except (KeyError, pygit2.InvalidSpecError):
+                # not a branch (e.g. a tag or HEAD~1). A failed clone leaves
+                # dest empty, so it can be cloned into again below.
+                pass
+        if repo is None:
+            repo = pygit2.clone_repository(url, dest, callbacks=_pygit2_callbacks())
+            if gitref:
+                try: commit, _ = repo.resolve_refish(gitref)
+                except (KeyError, pygit2.InvalidSpecError):
+                    # branches other than the default only exist as remote branches
+                    try: commit, _ = repo.resolve_refish("origin/" + gitref)
+                    except (KeyError, pygit2.InvalidSpecError):
+                        raise RuntimeError("Git checkout failed: %s not found." % gitref)
+                repo.checkout_tree(commit)
+                repo.set_head(commit.id)
+        if is_remote:
+            repo.submodules.update(init=True)
+    except (pygit2.GitError, KeyError, ValueError, AttributeError) as e:
+        # AttributeError comes from older pygit2 versions without submodules.update
+        raise RuntimeError("Git clone failed: %s" % e)
+
+def _clear_dir(path):
+    """Remove everything inside the directory path, but not path itself."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+def _has_branch_or_tag(git_exe, url, gitref):
+    """Check whether the repository at url has a branch or tag named gitref."""
+    ls_proc = subprocess.run([git_exe, "ls-remote", "--exit-code", url,
+                              "refs/heads/" + gitref, "refs/tags/" + gitref],
+                             stdout=subprocess.DEVNULL)
+    # --exit-code makes ls-remote exit with 2 when nothing matches
+    if ls_proc.returncode not in (0, 2):
+        raise RuntimeError("Git ls-remote failed with code %i." % ls_proc.returncode)
+    return ls_proc.returncode == 0
+
+def _git_clone(git_exe, url, dest, is_remote, gitref=None):
+    """Clone url into dest and check out gitref, if provided. The clone is done
+    in-process with pygit2 if it is installed, falling back to running git_exe if
+    that fails or pygit2 is missing."""
+    if pygit2 is not None:
+        try:
+            _pygit2_clone(url, dest, is_remote, gitref)
+            return
+        except RuntimeError:
+            if git_exe is None:
+                raise
+            # retry with the git executable, starting from a clean directory
+            if os.path.isdir(dest):
+                _clear_dir(dest)
+
+    clone_args = [git_exe, "clone"]
+    if is_remote:
+        # fetch submodules in parallel. Local clones are limited by the disk,
+        # so extra jobs don't help there.
+        clone_args += ["--recurse-submodules", "--jobs", _git_jobs]
     else:
-        if verbose:
-            print("Create directory: %s" % path)
-        if not dry_run:
-            try: os.mkdir(path)
+        # borrow the source's object database rather than copying it. This
+        # makes the clone depend on the source repo, which is fine since the
+        # clone is temporary and never modifies it.
+        clone_args.append("--shared")
+    checked_out = False
+    if gitref and not _looks_like_commit(gitref):
+        # branches and tags can be checked out by clone itself, which skips
+        # fetching history that isn't needed (for remotes) and a separate
+        # checkout
+        branch_args = clone_args + ["--branch", gitref, "--single-branch"]
+        if is_remote:
+            # --depth is ignored (with a warning) for local clones
+            branch_args += ["--depth", "1"]
+        # check that gitref names a branch or tag before asking clone for it,
+        # so that other refs (like HEAD~1) don't print a spurious error. Git
+        # only shows progress when it writes to a terminal, so the clone
+        # itself must not have its output captured.
+        if _has_branch_or_tag(git_exe, url, gitref):
+            branch_proc = subprocess.run(branch_args + [url, dest])
+            if branch_proc.returncode != 0:
+                raise RuntimeError("Git clone failed with code %i." % branch_proc.returncode)
+            checked_out = True
+    if not checked_out:
+        clone_proc = subprocess.run(clone_args + [url, dest])
+        if clone_proc.returncode != 0:
+            raise RuntimeError("Git clone failed with code %i." % clone_proc.returncode)
+
+    if gitref and not checked_out:   # perform checkout
+        ck_proc = subprocess.run([git_exe, "-C", dest, "checkout", gitref])
+        if ck_proc.returncode != 0:
+            raise RuntimeError("Git checkout failed with code %i." % ck_proc.returncode)
+
+def _stat_mode(path):
+    """Return the st_mode of path, or None if it doesn't exist. This lets
+    callers tell directories, other files, and missing paths apart with a single
+    stat, instead of calling both os.path.isdir and os.path.exists."""
+    try: return os.stat(path).st_mode
+    except (OSError, ValueError): return None
+
+def _is_repo_root(path):
+    """Check whether path is the top directory of a git repository, either bare
+    or with a worktree."""
+    return (os.path.exists(os.path.join(path, ".git"))
+            or (os.path.isfile(os.path.join(path, "HEAD"))
+                and os.path.isdir(os.path.join(path, "objects"))))
+
+def _git_worktree_add(git_exe, repo_dir, dest, gitref):
+    """Check out gitref from repo_dir into a new worktree at dest. Returns False
+    if repo_dir refuses the worktree (e.g. it's read-only, owned by another
+    user, or a hook fails), in which case it can still be cloned."""
+    # stderr is only shown on success or for a bad gitref. Other errors are
+    # handled by cloning instead.
+    wt_proc = subprocess.run([git_exe, "-C", repo_dir, "worktree", "add", "--detach",
+                              dest, gitref], stderr=subprocess.PIPE, text=True)
+    if wt_proc.returncode == 0:
+        sys.stderr.write(wt_proc.stderr)
+        return True
+    # rev-parse exits with 1 exactly when the repo is readable but gitref
+    # doesn't name a commit, and cloning won't change that
+    rp_proc = subprocess.run([git_exe, "-C", repo_dir, "rev-parse", "--verify", "--quiet",
+                              gitref + "^{commit}"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if rp_proc.returncode == 1:
+        sys.stderr.write(wt_proc.stderr)
+        raise RuntimeError("Git worktree add failed with code %i." % wt_proc.returncode)
+    return False
+
+def _git_worktree_remove(git_exe, repo_dir, dest):
+    # this runs during cleanup, so errors are ignored (and not shown). git will
+    # eventually prune the entry by itself anyway.
+    subprocess.run([git_exe, "-C", repo_dir, "worktree", "remove", "--force", dest],
+                   stderr=subprocess.DEVNULL)
+
+def _mkdir_many(paths, verbose=False, dry_run=False):
+    """Create the directories in paths, in order, skipping ones that already
+    exist. Parent directories must precede their children. Returns a list of the
+    directories that were (or for a dry run, would have been) created.
+    """
+    created = []
+    for path in paths:
+        # just try mkdir rather than checking for existence first, so each
+        # directory costs one syscall instead of two
+        if dry_run:
+            exists = os.path.exists(path)
+        else:
+            try:
+                os.mkdir(path)
+                exists = False
+            except FileExistsError:
+                exists = True
             except: raise RuntimeError("Failed to create directory: %s" % path)
+        if exists:
+            if verbose:
+                print("Directory already exists: %s" % path)
+        else:
+            if verbose:
+                print("Create directory: %s" % path)
+            created.append(path)
+    return created
+
+def _copy_in_kernel(src_fd, dest_fd):
+    """Copy the contents of src_fd to dest_fd without passing the data through
+    user space, by reflinking or with copy_file_range. Returns False if neither
+    is supported for these files, in which case nothing has been copied."""
+    if _FICLONE is not None:
+        # on CoW filesystems (btrfs, XFS) this shares extents instead of
+        # copying any data at all
+        try:
+            fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+            return True
+        except OSError:
+            pass
+    if hasattr(os, "copy_file_range"):
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(src_fd, dest_fd, 1 << 30)
+                if n == 0:
+                    return True
+                copied += n
+        except OSError as e:
+            # e.g. EXDEV on older kernels or ENOSYS. Only fall back if nothing
+            # was written yet.
+            if copied > 0:
+                raise
+    return False
+
+def _copy_file(src, dest):
+    """Copy the contents and permission bits of src to dest, like shutil.copy,
+    but keeping the data inside the kernel where possible."""
+    # opening dest truncates it, which would wipe out src if dest is (say) a
+    # symlink back into the source
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("%r and %r are the same file" % (src, dest))
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        done = _copy_in_kernel(fsrc.fileno(), fdest.fileno())
+    if not done:
+        shutil.copyfile(src, dest)
+    shutil.copymode(src, dest)
+
+def _try_copy(src, dest):
+    try: _copy_file(src, dest)
+    except: raise RuntimeError("Failed to overwrite file: %s" % dest)
 
 def _do_copy(src, dest, verbose=False, dry_run=False, overwrite=False):
     if verbose:
         print("%s file: %s" % (("Overwrite" if overwrite else "Create"), dest))
     if not dry_run:
-        try: shutil.copy(src, dest)
-        except: raise RuntimeError("Failed to overwrite file: %s" % dest)
+        _try_copy(src, dest)
+
+_copy_workers = min(32, (os.cpu_count() or 4) * 4)
+"""Maximum number of threads used to copy files."""
+
+def _do_copy_batch(ops, verbose=False, dry_run=False):
+    """Perform a batch of copies. ops is a list of tuples (src, dest, overwrite)
+    with the same meaning as the arguments to _do_copy. Checks on the
+    destination paths should be done before calling this, so that the batch
+    is not interrupted by errors which could have been detected in advance.
+    """
+    if verbose:
+        for src, dest, overwrite in ops:
+            print("%s file: %s" % (("Overwrite" if overwrite else "Create"), dest))
+    if dry_run or len(ops) == 0:
+        return
+    # copying is I/O bound and the GIL is released while the kernel does the
+    # work, so running copies in threads keeps the disk's queue full
+    with concurrent.futures.ThreadPoolExecutor(min(_copy_workers, len(ops))) as pool:
+        futures = [pool.submit(_try_copy, src, dest) for src, dest, _ in ops]
+        for fut in futures:
+            fut.result()
 
 def _prompt_to_overwrite(src, dest, verbose=False, dry_run=False):
     ow = False
@@ -70,32 +367,114 @@ def _prompt_to_overwrite(src, dest, verbose=False, dry_run=False):
     return res
 
 
-def _scan_dir(dir_path, rel_to):
-    """Recursively scan a directory, returning two lists of paths: one for all
-    files, and one for all subdirectories. The subdirectories are ordered so
-    that parent directories always precede their children. Returned paths are
-    given relative to rel_to, and dir_path must also be a relative path taken
-    relative to rel_to.
+def _add_parents(path, seen, out):
+    """Append the parent directories of the relative path to out, outermost
+    first, skipping any that are already in the set seen. seen is updated with
+    the directories that get added. path must use "/" as its separator, on
+    every platform."""
+    # find each "/" in one forward pass, rather than repeatedly taking dirname,
+    # which reparses the whole path every time
+    i = path.find("/")
+    while i >= 0:
+        d = path[:i]
+        if d not in seen:
+            seen.add(d)
+            out.append(d)
+        i = path.find("/", i + 1)
+
+def _list_dirs(dir_paths, rel_to):
+    """List a batch of directories for _scan_dirs (non-recursively), returning
+    their files and subdirectories as paths relative to rel_to, along with the
+    full paths and inode numbers of the files."""
+    files = []
+    subdirs = []
+    full_paths = []
+    inodes = []
+    for d in dir_paths:
+        # relative paths built by the scanner always use "/" as a separator,
+        # so they can be joined by concatenation instead of os.path.join
+        prefix = d + "/" if d else ""
+        # close each directory as soon as it's read rather than waiting on the
+        # garbage collector
+        with os.scandir(os.path.join(rel_to, d)) as it:
+            for x in it:
+                if x.is_dir():
+                    subdirs.append(prefix + x.name)
+                else:
+                    files.append(prefix + x.name)
+                    # scandir has already joined the path, and the inode is
+                    # free on POSIX, since it comes from the directory entry
+                    full_paths.append(x.path)
+                    inodes.append(x.inode())
+    return files, subdirs, full_paths, inodes
+
+_scan_workers = (os.cpu_count() or 4) * 2
+"""Maximum number of threads used to list directories."""
+
+_scan_batch = 64
+"""Maximum number of directories listed by a single scanning task."""
+
+_scan_parallel_min = 8
+"""Number of directories waiting to be listed at which _scan_dirs starts using
+threads. Smaller trees are listed serially, since starting a thread pool would
+cost more than it saves."""
+
+def _scan_dirs(dir_paths, rel_to):
+    """Recursively scan several directories, returning two lists of paths: one
+    for all files, and one for all subdirectories. Both are sorted, so the
+    subdirectories are ordered so that parent directories always precede their
+    children. Returned paths are given relative to rel_to, and dir_paths must
+    also be relative paths taken relative to rel_to. Two more lists give the
+    full path (including rel_to) and the inode number of each file.
     """
     subdirs = []
     files = []
-    for x in os.scandir(os.path.join(rel_to, dir_path)):
-        if x.is_dir():
-            subdirs.append(os.path.join(dir_path, x.name))
-        else:
-            files.append(os.path.join(dir_path, x.name))
-
-    i = 0
-    while i < len(subdirs):
-        d = subdirs[i]
-        base = os.path.join(rel_to, d)
-        i += 1
-        for x in os.scandir(base):
-            if x.is_dir():
-                subdirs.append(os.path.join(d, x.name))
-            else:
-                files.append(os.path.join(d, x.name))
+    full_paths = []
+    inodes = []
+    def merge(result):
+        fs, ds, ps, ns = result
+        files.extend(fs)
+        subdirs.extend(ds)
+        full_paths.extend(ps)
+        inodes.extend(ns)
+        frontier.extend(ds)
+    # directories waiting to be listed. Consumed entries are dropped from the
+    # front, so memory use follows the frontier rather than the whole tree.
+    frontier = collections.deque(dir_paths)
+    while frontier and len(frontier) < _scan_parallel_min:
+        merge(_list_dirs([frontier.popleft()], rel_to))
+    if frontier:
+        # listing a directory is spent almost entirely waiting on the kernel, so
+        # threads let us have several listings in flight at once. Results are
+        # only merged on this thread, so no locking is needed.
+        with concurrent.futures.ThreadPoolExecutor(_scan_workers) as pool:
+            pending = set()
+            while frontier or pending:
+                # split the frontier into batches, so that large trees don't pay
+                # for a task per directory, but small ones still use every worker
+                n = min(_scan_batch, max(1, -(-len(frontier) // _scan_workers)))
+                while frontier:
+                    batch = [frontier.popleft() for _ in range(min(n, len(frontier)))]
+                    pending.add(pool.submit(_list_dirs, batch, rel_to))
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    merge(fut.result())
+
+    # results arrive in whatever order the threads finish, so sort them to keep
+    # output reproducible. A directory is a prefix of its children's paths, so
+    # sorting keeps parents first.
+    subdirs.sort()
+    order = sorted(range(len(files)), key=files.__getitem__)
+    files = [files[i] for i in order]
+    full_paths = [full_paths[i] for i in order]
+    inodes = [inodes[i] for i in order]
+    return files, subdirs, full_paths, inodes
 
+def _scan_dir(dir_path, rel_to):
+    """Like _scan_dirs, but for a single directory, and only returning the first
+    two lists."""
+    files, subdirs, _, _ = _scan_dirs([dir_path], rel_to)
     return files, subdirs
 
 
@@ -106,11 +485,13 @@ class PutconfSource:
     """Path used to store this directory."""
     is_remote : bool
     """Whether this source was fetched from a remote repository."""
-    src_files : list
-    """List of tuples (from,to), where from is absolute path to a file in source
-    and to is the corresponding relative path in target. Contains all files that
-    that should be installed during a put, or overwritten by a sync, except for
-    those contained in explicit_subdirs."""
+    src_abs : list
+    """Absolute paths of files in source. Contains all files that should be
+    installed during a put, or overwritten by a sync, except for those contained
+    in explicit_subdirs."""
+    src_rel : list
+    """Relative paths in target corresponding to the files in src_abs, which has
+    the same length and order."""
     put_subdirs : list
     """Relative paths of directories that should be created during a put,
     excluding the ones in explicit_subdirs."""
@@ -118,9 +499,10 @@ class PutconfSource:
     """List of subdirectories relative to target that are explicitly named in a
     provied file list."""
     sync_new : list
-    """Like files, but contains paths from a provided file_list which do not yet
-    exist in source. Since these do not exist, they may possibly correspond to
-    directories to be installed during sync operations."""
+    """List of tuples (from,to), like src_abs and src_rel, but contains paths
+    from a provided file_list which do not yet exist in source. Since these do
+    not exist, they may possibly correspond to directories to be installed
+    during sync operations."""
     has_explicit_files : bool
     """Whether a file list was provided. This affects error generation during
     sync operations."""
@@ -132,34 +514,45 @@ class PutconfSource:
                  gitref : typing.Optional[str] = None,
                  pull : bool = False,
                  git_exe : typing.Optional[str] = None):
-        """file_list can only contain paths relative to target, so some processing
-        has to be done to the FILES argument before this method gets called.
+        """file_list can only contain paths relative to target, using "/" as the
+        separator on every platform, so some processing has to be done to the
+        FILES argument before this method gets called.
         """
 
         self.is_remote = is_remote
+        self._src_dirs = {}
 
         # get source directory ready
         if is_remote or gitref:   # clone repo
-            if git_exe is None:
+            if not _have_git(git_exe):
                 raise RuntimeError("Git not found.")
             try:
                 self.tmp = tempfile.TemporaryDirectory("__putconf-source")
                 self.work_dir = self.tmp.name
             except: raise RuntimeError("Couldn't create temporay directory for source.")
 
-            # TODO: decide whether it's worth adding --shared for local repos
-            clone_args = [git_exe, "clone", path, self.work_dir]
-            clone_proc = subprocess.run(clone_args)
-            if clone_proc.returncode != 0:
-                raise RuntimeError("Git clone failed with code %i." % clone_proc.returncode)
-
-            # pull is ignored for remote repos
-            if pull and not is_remote == "file": _git_pull(git_exe, self.work_dir)
+            # pull is ignored for remote repos. For local repos, update the
+            # source itself so the clone picks up the new commits. (Pulling
+            # in the fresh clone would never fetch anything.)
+            if pull and not is_remote: _git_pull(git_exe, path)
 
-            if gitref:   # perform checkout
-                ck_proc = subprocess.run([git_exe, "-C", self.work_dir, "checkout", gitref])
-                if ck_proc.returncode != 0:
-                    raise RuntimeError("Git checkout failed with code %i." % ck_proc.returncode)
+            if is_remote or git_exe is None or not _is_repo_root(path):
+                _git_clone(git_exe, path, self.work_dir, is_remote, gitref)
+            else:
+                # a worktree shares the source's objects, so checking out gitref
+                # takes a single git process and copies no objects
+                if _git_worktree_add(git_exe, path, self.work_dir, gitref):
+                    # this has to run before tmp is cleaned up, so that the
+                    # source isn't left with a stale worktree entry
+                    weakref.finalize(self, _git_worktree_remove, git_exe, path, self.work_dir)
+                else:
+                    # a failing hook leaves the worktree registered, so drop it
+                    # before cloning instead
+                    if os.path.exists(os.path.join(self.work_dir, ".git")):
+                        _git_worktree_remove(git_exe, path, self.work_dir)
+                    if os.path.isdir(self.work_dir):
+                        _clear_dir(self.work_dir)
+                    _git_clone(git_exe, path, self.work_dir, False, gitref)
 
         else:  # proto=="file", no --checkout, don't clone
             if not os.path.exists(path):
@@ -171,7 +564,7 @@ class PutconfSource:
             self.tmp = None
             self.work_dir = path
             if pull:
-                if git_exe is None:
+                if not _have_git(git_exe):
                     raise RuntimeError("Git not found.")
                 _git_pull(git_exe, self.work_dir)
 
@@ -190,7 +583,8 @@ class PutconfSource:
     def _scan_from_list(self, file_list):
         # note that file_list contains relative paths only, which must be
         # assured by the program before instances of this class are constructed
-        self.src_files = []
+        self.src_abs = []
+        self.src_rel = []
         self.put_subdirs = []
         self.explicit_subdirs = []
         self.sync_new = []
@@ -208,19 +602,14 @@ class PutconfSource:
                 undot_list.append(x)
                 src_path = os.path.join(src, x)
             # add parent directories to put_subdirs as necessary
-            d = os.path.dirname(x)
-            parents = []
-            while len(d) > 0 and d not in subdir_set:
-                subdir_set.add(d)
-                parents.append(d)
-                d = os.path.dirname(d)
-            for p in reversed(parents):
-                self.put_subdirs.append(p)
-
-            if os.path.isdir(src_path): # is directory in src
+            _add_parents(x, subdir_set, self.put_subdirs)
+
+            mode = _stat_mode(src_path)
+            if mode is not None and stat.S_ISDIR(mode): # is directory in src
                 self.explicit_subdirs.append(x)
-            elif os.path.exists(src_path): # is file in src
-                self.src_files.append((src_path, x))
+            elif mode is not None: # is file in src
+                self.src_abs.append(src_path)
+                self.src_rel.append(x)
             else: # not in src
                 # FIXME: in this case it doen't make sense to append parent
                 # directories to put_subdirs
@@ -234,7 +623,9 @@ class PutconfSource:
         self.explicit_subdirs = []
 
         # scan the top directory,
-        self.src_files = []
+        self.src_abs = []
+        self.src_rel = []
+        src_inodes = []
         src = self.work_dir
         subdirs = []
         dotfile_dir = None
@@ -245,102 +636,139 @@ class PutconfSource:
                 if x.is_dir():
                     subdirs.append(x.name)
                 else:
-                    self.src_files.append((x.path, x.name))
+                    self.src_abs.append(x.path)
+                    self.src_rel.append(x.name)
+                    src_inodes.append(x.inode())
 
         self.put_subdirs = subdirs.copy()
-        for x in subdirs:
-            fs, ds = _scan_dir(x, src)
-            self.src_files.extend([(os.path.join(src, f), f) for f in fs])
-            self.put_subdirs.extend(ds)
+        fs, ds, ps, ns = _scan_dirs(subdirs, src)
+        self.src_abs.extend(ps)
+        self.src_rel.extend(fs)
+        src_inodes.extend(ns)
+        self.put_subdirs.extend(ds)
 
         if dotfile_dir:
-            fs, ds = _scan_dir("", dotfile_dir)
-            self.src_files.extend([(os.path.join(dotfile_dir, f), _prepend_dot(f))
-                                   for f in fs])
+            fs, ds, ps, ns = _scan_dirs([""], dotfile_dir)
+            self.src_abs.extend(ps)
+            self.src_rel.extend([_prepend_dot(f) for f in fs])
+            src_inodes.extend(ns)
             self.put_subdirs.extend([_prepend_dot(d) for d in ds])
 
+        # order files by inode, which tends to follow their placement on disk,
+        # so that copying them reads the source more sequentially. Directories
+        # are all created before copying starts, so this order is safe.
+        order = sorted(range(len(src_inodes)), key=src_inodes.__getitem__)
+        self.src_abs = [self.src_abs[i] for i in order]
+        self.src_rel = [self.src_rel[i] for i in order]
+
     def install_to_target(self, target : str, verbose : bool, dry_run : bool,
                           overwrite : OverwriteMode):
         """Copy config files to target."""
         # scan all explicit subdirs first
         extra_dirs = []
-        extra_files = []
+        extra_abs = [] # like self.src_abs
+        extra_rel = [] # like self.src_rel
         for x in self.explicit_subdirs:
             extra_dirs.append(x)
             in_src = self._path_in_src(x)
-            fs, ds = _scan_dir("", in_src)
-            extra_files.extend([(os.path.join(in_src, f),os.path.join(x,f))
-                                for f in fs])
-            extra_dirs.extend([os.path.join(x, d) for d in ds])
+            fs, ds, ps, _ = _scan_dirs([""], in_src)
+            extra_abs.extend(ps)
+            extra_rel.extend([x + "/" + f for f in fs])
+            extra_dirs.extend([x + "/" + d for d in ds])
 
         # create directories in target
-        for d in itertools.chain(self.put_subdirs, extra_dirs):
-            abs_path = os.path.join(target, d)
-            _do_mkdir(abs_path, verbose, dry_run)
-
-        # copy files to target
-        for src_path, rel in itertools.chain(self.src_files, extra_files):
+        fresh_dirs = set(_mkdir_many([os.path.join(target, d)
+                                      for d in itertools.chain(self.put_subdirs, extra_dirs)],
+                                     verbose, dry_run))
+
+        # copy files to target. Copies that don't require user interaction are
+        # collected and performed together at the end.
+        ops = []
+
+        # how to handle files that already exist in target. Each returns the
+        # overwrite mode to use from then on.
+        def prompt(src_path, abs_path):
+            return _prompt_to_overwrite(src_path, abs_path, verbose, dry_run)
+        def overwrite_all(src_path, abs_path):
+            ops.append((src_path, abs_path, True))
+            return OverwriteMode.ALL
+        def overwrite_none(src_path, abs_path):
+            if verbose or dry_run:
+                print("Don't overwrite: %s" % abs_path)
+            return OverwriteMode.NONE
+        strategies = {
+            OverwriteMode.PROMPT: prompt,
+            OverwriteMode.ALL: overwrite_all,
+            OverwriteMode.NONE: overwrite_none,
+        }
+        on_existing = strategies[overwrite]
+
+        for src_path, rel in zip(itertools.chain(self.src_abs, extra_abs),
+                                 itertools.chain(self.src_rel, extra_rel)):
             abs_path = os.path.join(target, rel)
-            if os.path.isdir(abs_path):
+            if os.path.dirname(abs_path) in fresh_dirs:
+                # the parent directory was just created, so it's empty and
+                # there's no need to check the destination
+                mode = None
+            else:
+                mode = _stat_mode(abs_path)
+            if mode is None:
+                ops.append((src_path, abs_path, False))
+            elif stat.S_ISDIR(mode):
                 raise RuntimeError("%s exists and is a directory." % abs_path)
-            elif os.path.exists(abs_path):
-                match overwrite:
-                    case OverwriteMode.PROMPT:
-                        overwrite = _prompt_to_overwrite(src_path, abs_path, verbose, dry_run)
-                    case OverwriteMode.ALL:
-                        _do_copy(src_path, abs_path, verbose, dry_run, True)
-                    case OverwriteMode.NONE:
-                        if verbose or dry_run:
-                            print("Don't overwrite: %s" % abs_path)
-                        # do nothing
-                        ...
             else:
-                _do_copy(src_path, abs_path, verbose, dry_run)
+                new_mode = on_existing(src_path, abs_path)
+                if new_mode != overwrite:
+                    overwrite = new_mode
+                    on_existing = strategies[overwrite]
+        _do_copy_batch(ops, verbose, dry_run)
 
     def _path_in_src(self, rel_to_target : str):
-        if rel_to_target.startswith(""):
-            return os.path.join(self.work_dir, ".dotfiles", rel_to_target[1:])
-        else:
-            return os.path.join(self.work_dir, rel_to_target)
+        # this is called for every file in scanned directories, which mostly
+        # share a few toplevel components, so cache where each one lives
+        head, sep, tail = rel_to_target.partition("/")
+        base = self._src_dirs.get(head)
+        if base is None:
+            if head.startswith("."):
+                base = os.path.join(self.work_dir, ".dotfiles", head[1:])
+            else:
+                base = os.path.join(self.work_dir, head)
+            self._src_dirs[head] = base
+        return base + sep + tail
 
     def sync_from_target(self, target : str, verbose : bool, dry_run : bool):
-        extra_files = [] # like self.src_files
+        extra_src = [] # like self.src_abs
+        extra_rel = [] # like self.src_rel
 
-        # ensure existence, add extra_files, make directories
+        # ensure existence, add extra files, make directories
         if self.has_explicit_files:
             # Steps:
             # - scan entries of sync_new and explicit_subdirs in target
             #   - raise errors when they don't exist
             #   - make list of directories to create
-            # - scan src_files and raise errors on missing files in target
+            # - scan src_rel and raise errors on missing files in target
             # - create new directories
             extra_dirs = [] # note: paths relative to target
-            extra_files = [] # like self.src_files
             subdir_set = set() # ensure directories are just created once
             # scan sync_new
             for in_src, rel in self.sync_new:
                 # append parent directories as necessary
-                d = os.path.dirname(rel)
-                parents = []
-                while len(d) > 0 and d not in subdir_set:
-                    subdir_set.add(d)
-                    parents.append(d)
-                    d = os.path.dirname(d)
-                for p in reversed(parents):
-                    extra_dirs.append(p)
+                _add_parents(rel, subdir_set, extra_dirs)
                 # handle the file/directory
                 in_target = os.path.join(target, rel)
-                if os.path.isdir(in_target):
+                mode = _stat_mode(in_target)
+                if mode is not None and stat.S_ISDIR(mode):
                     # scan directory
                     if rel not in subdir_set:
                         extra_dirs.append(rel)
                     fs, ds = _scan_dir(rel, target)
                     extra_dirs.extend(ds)
-                    extra_files.extend([(self._path_in_src(f), f)
-                                        for f in fs])
-                elif os.path.exists(in_target):
+                    extra_src.extend([self._path_in_src(f) for f in fs])
+                    extra_rel.extend(fs)
+                elif mode is not None:
                     # add file
-                    extra_files.append((in_src, rel))
+                    extra_src.append(in_src)
+                    extra_rel.append(rel)
                 else:
                     raise RuntimeError("%s does not exist." % in_target)
             for rel in self.explicit_subdirs:
@@ -350,29 +778,34 @@ class PutconfSource:
                         extra_dirs.append(rel)
                     fs, ds = _scan_dir(rel, target)
                     extra_dirs.extend(ds)
-                    extra_files.extend([(self._path_in_src(f), f)
-                                        for f in fs])
+                    extra_src.extend([self._path_in_src(f) for f in fs])
+                    extra_rel.extend(fs)
                 else:
                     raise RuntimeError("%s is not a directory." % in_target)
 
             # make directories
             dotfile_dir = os.path.join(self.work_dir, ".dotfiles")
-            if not os.path.isdir(dotfile_dir):
-                _do_mkdir(dotfile_dir, verbose, dry_run)
-            for x in extra_dirs:
-                _do_mkdir(self._path_in_src(x), verbose, dry_run)
+            _mkdir_many([dotfile_dir] + [self._path_in_src(x) for x in extra_dirs],
+                        verbose, dry_run)
 
         # sync files
-        for in_src, rel in itertools.chain(extra_files, self.src_files):
+        ops = []
+        n_extra = len(extra_src)
+        for i, (in_src, rel) in enumerate(zip(itertools.chain(extra_src, self.src_abs),
+                                              itertools.chain(extra_rel, self.src_rel))):
             in_target = os.path.join(target, rel)
-            if os.path.isdir(in_target):
+            mode = _stat_mode(in_target)
+            if mode is not None and stat.S_ISDIR(mode):
                 raise RuntimeError("%s is a directory." % in_target)
-            elif os.path.exists(in_target):
-                overwrite = os.path.exists(in_src)
-                _do_copy(in_target, in_src, verbose, dry_run, overwrite)
+            elif mode is not None:
+                # files in src_abs were found while scanning, so they're known
+                # to exist without checking again
+                overwrite = i >= n_extra or os.path.exists(in_src)
+                ops.append((in_target, in_src, overwrite))
             elif self.has_explicit_files:
                 # explicitly named files must exist
                 # FIXME: this might be unexpected when using the --all flag
                 raise RuntimeError("%s does not exist." % in_target)
             elif verbose:
                 print("Don't overwrite: %s (no file in target)" % in_src)
+        _do_copy_batch(ops, verbose, dry_run)
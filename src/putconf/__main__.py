@@ -1,41 +1,73 @@
-import argparse
-from pathlib import Path
-import re
+import functools
 import sys
+import types
 import os
 
-from putconf.PutconfSource import OverwriteMode, PutconfSource
- 
-def find_git():
-    for d in os.get_exec_path():
-        e = os.path.join(d, "git")
-        if os.path.exists(e):
-            return e
-    return None
+_remote_protos = frozenset(["http", "https", "ssh", "git"])
+"""Protocols for which SOURCE is a remote git repository."""
 
 def decomp_source(source_str):
     """Break source_string into a protocol and a path and return proto, path. If
     source_str does not begin with <proto>:// then proto will be "file".
     """
-    proto = "file"
-    path = ""
-    # check if source is a path or a url
-    match = re.match(r"(?P<proto>\w+)://(?P<path>.*)", source_str)
-    if match:
-        proto = match.group("proto")
-        path = match.group("path")
-    else:
-        path = source_str
-    return proto, path
-
-def as_rel_path(p, rel_to):
-    real_p = os.path.realpath(p)
-    real_rel_to = os.path.realpath(rel_to)
-    common = os.path.commonpath([real_p, real_rel_to])
-    if common != real_rel_to:
+    # a plain string search is enough here, and avoids importing re
+    i = source_str.find("://")
+    if i > 0 and all(c.isalnum() or c == "_" for c in source_str[:i]):
+        return source_str[:i], source_str[i+3:]
+    return "file", source_str
+
+@functools.lru_cache(maxsize=None)
+def _realdir(path):
+    """os.path.realpath, cached since FILES often share parent directories."""
+    return os.path.realpath(path)
+
+def _is_within(path, directory):
+    """Whether path is directory or inside it. Both must be normalized absolute
+    paths, so a string prefix test is enough."""
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+def _abspath(p, cwd):
+    """Like os.path.abspath, but relative to cwd rather than calling getcwd."""
+    return os.path.normpath(p if os.path.isabs(p) else os.path.join(cwd, p))
+
+def as_rel_path(p, rel_to, abs_rel_to=None, cwd=None):
+    """Return p as a path relative to rel_to, or None if p is not within rel_to.
+    abs_rel_to and cwd may be given to avoid normalizing rel_to and looking up
+    the working directory again on every call.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    # usually comparing normalized paths is enough, and that needs no syscalls.
+    # Symlinks are only resolved if it fails, e.g. because the target was
+    # given through a symlink.
+    abs_p = _abspath(p, cwd)
+    if abs_rel_to is None:
+        abs_rel_to = _abspath(rel_to, cwd)
+    if _is_within(abs_p, abs_rel_to):
+        return os.path.relpath(abs_p, abs_rel_to)
+
+    real_rel_to = _realdir(rel_to)
+    # only the parent directory is resolved, so that each directory is walked
+    # once no matter how many FILES it contains
+    head, tail = os.path.split(abs_p)
+    real_p = os.path.join(_realdir(head), tail)
+    if not _is_within(real_p, real_rel_to):
         return None
     return os.path.relpath(real_p, real_rel_to)
 
+def _die(msg):
+    """Print an error message to stderr and exit with status 1."""
+    sys.exit("Error: " + msg)
+
+def _rel_or_die(f, target, abs_target, cwd):
+    p = as_rel_path(f, target, abs_target, cwd)
+    if p is None:
+        _die("%s is not within %s." % (f, target))
+    # PutconfSource expects "/" as the separator, like its scanner produces
+    if os.sep != "/":
+        p = p.replace(os.sep, "/")
+    return p
+
 _program_usage ="""putconf [options] SOURCE [FILES ...]"""
 _program_description = """Install/sync user configuration files from a folder or git repository.
 
@@ -55,95 +87,175 @@ repositories. Using -S and --checkout together is only supported for
 remote repos. For local repos, synced files are written straight into
 the worktree."""
 
+_program_args = [
+    ("SOURCE", "Where config files are stored. (Path or URL)."),
+    ("FILES", "Which config files to act on. (Default all)."),
+]
+
+_program_options = [
+    # (group, flags, dest, metavar, help). Options without a metavar are
+    # boolean flags.
+    ("Global Options", ("-t", "--target"), "target", "TARGET",
+     "Where config files go. Defaults to $HOME."),
+    ("Global Options", ("-h", "--help"), "help", None,
+     "Show help and exit."),
+    ("Global Options", ("-v", "--verbose"), "verbose", None,
+     "Print extra information."),
+    ("Global Options", ("--checkout",), "checkout", "REF",
+     "Branch, commit, or tag to check out from source."),
+    ("Global Options", ("--pull",), "pull", None,
+     "When SOURCE is a local git repository, attempt to run `git pull` before install/sync."),
+    ("Global Options", ("--dry-run",), "dry_run", None,
+     "Do not actually install/sync files. Implies -v. (Git clone and pull operations will still be executed)."),
+    ("Global Options", ("--version",), "version", None,
+     "Show version and exit."),
+    ("Installation", ("-w", "--overwrite"), "overwrite", None,
+     "Overwrite existing files without prompting."),
+    ("Installation", ("-n", "--no-overwrite"), "no_overwrite", None,
+     "Never overwrite existing files."),
+    ("Synchronization", ("-S", "--sync-source"), "sync_source", None,
+     "Update SOURCE with config files from TARGET."),
+    #("Synchronization", ("-c", "--commit"), "commit", "MSG",
+    # "Commit changes to SOURCE with the given message."),
+    #("Synchronization", ("-P", "--push"), "push", None,
+    # "Push changes. Implied true when SOURCE is a remote repository. Requires -c."),
+]
+
+_flags = {flag: (dest, metavar is not None, flags)
+          for _, flags, dest, metavar, _ in _program_options
+          for flag in flags}
+"""Maps each option flag to (dest, takes_value, all_flags)."""
+
+def usage_error(msg):
+    """Print the usage line and msg to stderr and exit, like argparse does."""
+    sys.stderr.write("usage: %s\nputconf: error: %s\n" % (_program_usage, msg))
+    sys.exit(2)
+
+def _is_value(arg):
+    """Whether arg can be the value of an option, rather than an option itself.
+    A lone "-" is a value, as it conventionally names stdin or the previous
+    branch."""
+    return arg == "-" or not arg.startswith("-")
+
+def parse_argv(argv):
+    """Parse command line arguments in a single pass, returning a namespace with
+    an attribute for each option, as well as SOURCE and FILES. Options and
+    positional arguments may be intermixed.
+    """
+    args = types.SimpleNamespace(**{dest: None if metavar else False
+                                    for _, _, dest, metavar, _ in _program_options})
+    positional = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg == "--":
+            positional.extend(argv[i:])
+            break
+        elif arg.startswith("--"):
+            name, eq, value = arg.partition("=")
+            if name not in _flags:
+                usage_error("unrecognized arguments: %s" % arg)
+            dest, takes_value, flags = _flags[name]
+            if not takes_value:
+                if eq:
+                    usage_error("argument %s: ignored explicit argument '%s'"
+                                % ("/".join(flags), value))
+                setattr(args, dest, True)
+                continue
+            if not eq:
+                if i == len(argv) or not _is_value(argv[i]):
+                    usage_error("argument %s: expected one argument" % "/".join(flags))
+                value = argv[i]
+                i += 1
+            setattr(args, dest, value)
+        elif arg.startswith("-") and arg != "-":
+            # short flags may be combined, e.g. -vw, and the last one may take
+            # a value, either attached (-tDIR or -t=DIR) or as the next argument
+            j = 1
+            while j < len(arg):
+                name = "-" + arg[j]
+                j += 1
+                if name not in _flags:
+                    usage_error("unrecognized arguments: %s" % arg)
+                dest, takes_value, flags = _flags[name]
+                if not takes_value:
+                    setattr(args, dest, True)
+                    continue
+                if j < len(arg):
+                    value = arg[j:]
+                    if value.startswith("="):
+                        value = value[1:]
+                elif i == len(argv) or not _is_value(argv[i]):
+                    usage_error("argument %s: expected one argument" % "/".join(flags))
+                else:
+                    value = argv[i]
+                    i += 1
+                setattr(args, dest, value)
+                break
+        else:
+            positional.append(arg)
+
+    args.SOURCE = positional[0] if positional else None
+    args.FILES = positional[1:]
+    return args
+
+def format_help():
+    """Format the --help message in the same layout argparse would use."""
+    import shutil
+    import textwrap
+
+    width = shutil.get_terminal_size().columns - 2
+    help_width = max(width - 24, 11)
+
+    def entry(invocation, help_text):
+        lines = textwrap.wrap(help_text, help_width)
+        if len(invocation) <= 20:
+            res = ["  %-22s%s" % (invocation, lines[0])]
+            lines = lines[1:]
+        else:
+            res = ["  " + invocation]
+        res.extend(" " * 24 + line for line in lines)
+        return res
+
+    out = ["usage: " + _program_usage, "", _program_description, "", "Arguments:"]
+    for name, help_text in _program_args:
+        out.extend(entry(name, help_text))
+    group = None
+    for g, flags, _, metavar, help_text in _program_options:
+        if g != group:
+            group = g
+            out.extend(["", group + ":"])
+        if metavar:
+            invocation = ", ".join("%s %s" % (f, metavar) for f in flags)
+        else:
+            invocation = ", ".join(flags)
+        out.extend(entry(invocation, help_text))
+    out.extend(["", _program_epilog])
+    return "\n".join(out) + "\n"
+
 def main():
-    parser = argparse.ArgumentParser(usage=_program_usage,
-                                     description=_program_description,
-                                     epilog=_program_epilog,
-                                     add_help=False,
-                                     formatter_class=argparse.RawDescriptionHelpFormatter)
-
-    arg_group = parser.add_argument_group("Arguments")
-    # use nargs="?" so parse_args doesn't error when it's missing
-    arg_group.add_argument("SOURCE",
-                           help="Where config files are stored. (Path or URL).",
-                           nargs="?")
-    arg_group.add_argument("FILES",
-                           help="Which config files to act on. (Default all).",
-                           nargs="*")
-
-    glob_opts = parser.add_argument_group("Global Options")
-    glob_opts.add_argument("-t",
-                           "--target",
-                           help="Where config files go. Defaults to $HOME.")
-    glob_opts.add_argument("-h",
-                           "--help",
-                           action="store_true", help="Show help and exit.")
-    glob_opts.add_argument("-v",
-                           "--verbose",
-                           action="store_true",
-                           help="Print extra information.")
-    glob_opts.add_argument("--checkout",
-                           help="Branch, commit, or tag to check out from source.",
-                           metavar="REF")
-    glob_opts.add_argument("--pull",
-                           action="store_true",
-                           help="When SOURCE is a local git repository, attempt to run `git pull` before install/sync.")
-    glob_opts.add_argument("--dry-run",
-                           action="store_true",
-                           help="Do not actually install/sync files. Implies -v. (Git clone and pull operations will still be executed).")
-    glob_opts.add_argument("--version",
-                           action="store_true",
-                           help="Show version and exit.")
-
-    inst_opts = parser.add_argument_group("Installation")
-    inst_opts.add_argument("-w",
-                           "--overwrite",
-                           action="store_true",
-                           help="Overwrite existing files without prompting.")
-    inst_opts.add_argument("-n",
-                           "--no-overwrite",
-                           action="store_true",
-                           help="Never overwrite existing files.")
-
-    sync_opts = parser.add_argument_group("Synchronization")
-    sync_opts.add_argument("-S",
-                           "--sync-source",
-                           action="store_true",
-                           help="Update SOURCE with config files from TARGET.")
-    #sync_opts.add_argument("-c",
-    #                       "--commit",
-    #                       help="Commit changes to SOURCE with the given message.",
-    #                       metavar="MSG")
-    #sync_opts.add_argument("-P",
-    #                       "--push",
-    #                       action="store_true",
-    #                       help="Push changes. Implied true when SOURCE is a remote repository. Requires -c.")
-
-    # it's ok with me if parse_args errors out on an unrecognized option
-    args = parser.parse_intermixed_args()
+    # argparse is avoided since building the parser would dominate startup
+    args = parse_argv(sys.argv[1:])
 
     # ensure no mutually exclusive options are used together
     if args.overwrite and args.no_overwrite:
-        print("Error: --overwrite and --no-overwrite are mutually exclusive.")
-        sys.exit(1)
+        _die("--overwrite and --no-overwrite are mutually exclusive.")
     if args.sync_source:
         if args.overwrite or args.no_overwrite:
-            print("Error: --sync-source cannot be used with --overwrite or --no-overwrite.")
-            sys.exit(1)
+            _die("--sync-source cannot be used with --overwrite or --no-overwrite.")
     #else:
     #    if args.commit or args.push:
-    #        print("Error: --commit and --push require --sync-source.")
-    #        sys.exit(1)
+    #        _die("--commit and --push require --sync-source.")
 
     if args.help:
-        parser.print_help()
+        sys.stdout.write(format_help())
         sys.exit(1)
     elif args.version:
         print("putconf 0.1")
         sys.exit(0)
     elif not args.SOURCE:
-        print("Error: SOURCE is required.")
-        sys.exit(1)
+        _die("SOURCE is required.")
 
     dry_run = args.dry_run
     verbose = args.verbose
@@ -153,29 +265,28 @@ def main():
 
     proto, path = decomp_source(args.SOURCE)
     # check transport
-    is_remote = proto in ["http", "https", "ssh", "git"]
+    is_remote = proto in _remote_protos
     if not (is_remote or proto == "file"):
-        print("Error: Unsupported transport %s." % proto)
-        sys.exit(1)
+        _die("Unsupported transport %s." % proto)
 
     # sync operations only support local directories (for now)
     if args.sync_source and is_remote:
-        print("Error: Synchronization is only supported for local directories.")
-        sys.exit(1)
+        _die("Synchronization is only supported for local directories.")
 
-    git_exe = find_git()
+    # only search PATH for git when it might actually be needed
+    git_exe = None
+    if is_remote or args.pull or args.checkout:
+        import shutil
+        git_exe = shutil.which("git")
 
-    target = args.target if args.target else os.environ.get("HOME")
+    target = args.target or os.path.expanduser("~")
 
     # convert FILES to paths relative to target
-    files = [] # TODO
-    for f in args.FILES:
-        p = as_rel_path(f, target)
-        if not p:
-            print("Error: %s is not within %s." % (f, args.target))
-            sys.exit(1)
-        files.append(p)
+    cwd = os.getcwd()
+    abs_target = _abspath(target, cwd)
+    files = [_rel_or_die(f, target, abs_target, cwd) for f in args.FILES]
 
+    from putconf.PutconfSource import OverwriteMode, PutconfSource
     try:
         source = PutconfSource(path, is_remote, files, args.checkout, args.pull, git_exe)
         if args.sync_source:
@@ -188,8 +299,7 @@ def main():
                 ow_mode = OverwriteMode.NONE
             source.install_to_target(target, verbose, dry_run, ow_mode)
     except Exception as e:
-        print("Error: %s" % e)
-        sys.exit(1)
+        _die(str(e))
 
     
 
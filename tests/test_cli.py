@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: 2024-present U.N. Owen <void@some.where>
+#
+# SPDX-License-Identifier: MIT
+import os
+
+import pytest
+
+from putconf.__main__ import as_rel_path, parse_argv
+
+
+def test_intermixed():
+    args = parse_argv(["src", "-v", "a", "--target", "dir", "b"])
+    assert args.SOURCE == "src"
+    assert args.FILES == ["a", "b"]
+    assert args.verbose
+    assert args.target == "dir"
+    assert not args.overwrite
+
+
+def test_combined_short_flags():
+    args = parse_argv(["-vtDIR", "src"])
+    assert args.verbose
+    assert args.target == "DIR"
+    assert args.SOURCE == "src"
+    args = parse_argv(["-vwt", "DIR"])
+    assert args.verbose and args.overwrite
+    assert args.target == "DIR"
+
+
+def test_attached_values():
+    assert parse_argv(["--target=DIR"]).target == "DIR"
+    assert parse_argv(["-t=DIR"]).target == "DIR"
+    assert parse_argv(["--checkout=-"]).checkout == "-"
+
+
+def test_dash_value():
+    assert parse_argv(["-t", "-"]).target == "-"
+    assert parse_argv(["--checkout", "-"]).checkout == "-"
+    assert parse_argv(["src", "-"]).FILES == ["-"]
+
+
+def test_double_dash():
+    args = parse_argv(["src", "--", "-v", "--target"])
+    assert args.FILES == ["-v", "--target"]
+    assert not args.verbose
+    assert args.target is None
+
+
+@pytest.mark.parametrize("argv", [
+    ["-t"], ["-t", "-v"], ["--checkout", "--pull"], ["--verbose=yes"], ["-x"], ["--nope"],
+])
+def test_usage_errors(argv, capsys):
+    with pytest.raises(SystemExit) as e:
+        parse_argv(argv)
+    assert e.value.code == 2
+    assert "putconf: error:" in capsys.readouterr().err
+
+
+def test_rel_path_inside():
+    assert as_rel_path("/a/b/c", "/a") == os.path.join("b", "c")
+    assert as_rel_path("/a", "/a") == "."
+    assert as_rel_path("b/c", "/a", cwd="/a") == os.path.join("b", "c")
+    # .. is resolved lexically
+    assert as_rel_path("/a/x/../b", "/a") == "b"
+
+
+def test_rel_path_outside(tmp_path):
+    target = tmp_path / "a"
+    target.mkdir()
+    assert as_rel_path(str(tmp_path / "b"), str(target)) is None
+    assert as_rel_path(str(target / ".." / "b"), str(target)) is None
+    # a sibling whose name starts with the target's isn't inside it
+    (tmp_path / "ab").mkdir()
+    assert as_rel_path(str(tmp_path / "ab" / "c"), str(target)) is None
+
+
+def test_rel_path_root_target():
+    assert as_rel_path("/a/b", "/") == os.path.join("a", "b")
+    assert as_rel_path("/a/b", "/", cwd="/a") == os.path.join("a", "b")
+
+
+def test_rel_path_symlinked_target(tmp_path):
+    real = tmp_path / "real"
+    (real / "d").mkdir(parents=True)
+    link = tmp_path / "link"
+    link.symlink_to(real)
+    # FILES given through the real path are found inside a target given
+    # through the symlink, and the other way around
+    assert as_rel_path(str(real / "d" / "f"), str(link)) == os.path.join("d", "f")
+    assert as_rel_path(str(link / "d" / "f"), str(real)) == os.path.join("d", "f")
+    # but resolving symlinks doesn't let other paths in
+    assert as_rel_path(str(tmp_path / "f"), str(link)) is None
+
+
+def test_rel_path_through_symlink_in_target(tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    (target / "link").symlink_to(elsewhere)
+    # paths are compared lexically first, so a FILE under a symlinked
+    # directory in target is taken as it was given
+    assert as_rel_path(str(target / "link" / "f"), str(target)) == os.path.join("link", "f")
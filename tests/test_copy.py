@@ -0,0 +1,29 @@
+# SPDX-FileCopyrightText: 2024-present U.N. Owen <void@some.where>
+#
+# SPDX-License-Identifier: MIT
+import shutil
+
+import pytest
+
+from putconf.PutconfSource import _copy_file
+
+
+def test_copy_file(tmp_path):
+    src = tmp_path / "src"
+    src.write_text("contents")
+    src.chmod(0o640)
+    dest = tmp_path / "dest"
+    dest.write_text("old contents that are longer")
+    _copy_file(str(src), str(dest))
+    assert dest.read_text() == "contents"
+    assert dest.stat().st_mode & 0o777 == 0o640
+
+
+def test_copy_file_through_symlink(tmp_path):
+    src = tmp_path / "src"
+    src.write_text("contents")
+    dest = tmp_path / "dest"
+    dest.symlink_to(src)
+    with pytest.raises(shutil.SameFileError):
+        _copy_file(str(src), str(dest))
+    assert src.read_text() == "contents"
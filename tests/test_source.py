@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: 2024-present U.N. Owen <void@some.where>
+#
+# SPDX-License-Identifier: MIT
+import gc
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from putconf.PutconfSource import OverwriteMode, PutconfSource, _add_parents
+
+
+def test_path_in_src(tmp_path):
+    src = PutconfSource(str(tmp_path), False, [])
+    dotfiles = os.path.join(str(tmp_path), ".dotfiles")
+    # dotted toplevel names live under .dotfiles, without the dot
+    assert src._path_in_src(".bashrc") == os.path.join(dotfiles, "bashrc")
+    assert src._path_in_src(".config/app/rc") == os.path.join(dotfiles, "config") + "/app/rc"
+    # others live at the top of the source
+    assert src._path_in_src("bin") == os.path.join(str(tmp_path), "bin")
+    assert src._path_in_src("bin/tool") == os.path.join(str(tmp_path), "bin") + "/tool"
+    # cached toplevel names give the same answers
+    assert src._path_in_src(".config/other") == os.path.join(dotfiles, "config") + "/other"
+    assert src._path_in_src("bin/tool") == os.path.join(str(tmp_path), "bin") + "/tool"
+
+
+def test_add_parents():
+    seen = set()
+    out = []
+    _add_parents("a/b/c/file", seen, out)
+    # outermost first, and the file itself isn't a parent
+    assert out == ["a", "a/b", "a/b/c"]
+    # directories already seen are skipped
+    _add_parents("a/b/d/file", seen, out)
+    _add_parents("a/file", seen, out)
+    _add_parents("file", seen, out)
+    assert out == ["a", "a/b", "a/b/c", "a/b/d"]
+    assert seen == set(out)
+    # so are ones seen before starting
+    out = []
+    _add_parents("x/y/file", {"x"}, out)
+    assert out == ["x/y"]
+
+def make_tree(root, files):
+    for rel, text in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+
+def make_install(tmp_path):
+    src = tmp_path / "src"
+    make_tree(src, {
+        "bin/tool": "new tool",
+        "new/deep/file": "deep",
+        ".dotfiles/config/app/rc": "rc",
+        ".dotfiles/profile": "profile",
+    })
+    target = tmp_path / "target"
+    make_tree(target, {"bin/tool": "old tool"})
+    (target / ".config").mkdir()
+    return PutconfSource(str(src), False, []), target
+
+
+def test_install(tmp_path):
+    src, target = make_install(tmp_path)
+    src.install_to_target(str(target), False, False, OverwriteMode.NONE)
+    # new nested directories, and files inside existing directories
+    assert (target / "new/deep/file").read_text() == "deep"
+    assert (target / ".config/app/rc").read_text() == "rc"
+    assert (target / ".profile").read_text() == "profile"
+    # existing files are kept
+    assert (target / "bin/tool").read_text() == "old tool"
+
+
+def test_install_overwrite(tmp_path):
+    src, target = make_install(tmp_path)
+    src.install_to_target(str(target), False, False, OverwriteMode.ALL)
+    assert (target / "bin/tool").read_text() == "new tool"
+    assert (target / "new/deep/file").read_text() == "deep"
+
+
+def test_install_dry_run(tmp_path, capsys):
+    src, target = make_install(tmp_path)
+    # main() turns on verbose for dry runs
+    src.install_to_target(str(target), True, True, OverwriteMode.NONE)
+    out = capsys.readouterr().out
+    # directories that would be created are reported, and so are the files
+    # inside them, without creating anything
+    assert "Create directory: %s\n" % (target / "new") in out
+    assert "Create directory: %s\n" % (target / "new/deep") in out
+    assert "Directory already exists: %s\n" % (target / ".config") in out
+    assert "Create file: %s\n" % (target / "new/deep/file") in out
+    assert "Don't overwrite: %s\n" % (target / "bin/tool") in out
+    assert not (target / "new").exists()
+    assert not (target / ".profile").exists()
+    assert (target / "bin/tool").read_text() == "old tool"
+
+
+git_exe = shutil.which("git")
+needs_git = pytest.mark.skipif(git_exe is None, reason="git not found")
+
+def git(*args):
+    subprocess.run([git_exe, "-c", "user.name=putconf", "-c", "user.email=putconf@test",
+                    *args], check=True, capture_output=True)
+
+def make_repo(path):
+    make_tree(path, {"bin/tool": "one"})
+    git("init", "-q", str(path))
+    git("-C", str(path), "add", "-A")
+    git("-C", str(path), "commit", "-qm", "one")
+    git("-C", str(path), "tag", "t1")
+    (path / "bin/tool").write_text("two")
+    git("-C", str(path), "commit", "-qam", "two")
+
+def worktrees(repo):
+    proc = subprocess.run([git_exe, "-C", str(repo), "worktree", "list", "--porcelain"],
+                          check=True, capture_output=True, text=True)
+    return [l for l in proc.stdout.splitlines() if l.startswith("worktree ")]
+
+
+@needs_git
+def test_checkout_worktree(tmp_path):
+    repo = tmp_path / "repo"
+    make_repo(repo)
+    src = PutconfSource(str(repo), False, [], gitref="t1", git_exe=git_exe)
+    assert os.path.isfile(os.path.join(src.work_dir, ".git"))
+    assert len(worktrees(repo)) == 2
+    assert src.src_rel == ["bin/tool"]
+    with open(src.src_abs[0]) as f:
+        assert f.read() == "one"
+    # the worktree is removed along with the source
+    del src
+    gc.collect()
+    assert len(worktrees(repo)) == 1
+
+
+@needs_git
+def test_checkout_worktree_fallback(tmp_path):
+    repo = tmp_path / "repo"
+    make_repo(repo)
+    # a failing hook makes git worktree add fail after checking out
+    hook = repo / ".git/hooks/post-checkout"
+    hook.write_text("#!/bin/sh\nexit 1\n")
+    hook.chmod(0o755)
+    src = PutconfSource(str(repo), False, [], gitref="t1", git_exe=git_exe)
+    assert len(worktrees(repo)) == 1
+    with open(src.src_abs[0]) as f:
+        assert f.read() == "one"
+
+
+@needs_git
+def test_checkout_bad_ref(tmp_path, capfd):
+    repo = tmp_path / "repo"
+    make_repo(repo)
+    with pytest.raises(RuntimeError):
+        PutconfSource(str(repo), False, [], gitref="nosuch", git_exe=git_exe)
+    err = capfd.readouterr().err
+    assert "not a working tree" not in err
+    assert "Cloning" not in err
+    assert len(worktrees(repo)) == 1